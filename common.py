@@ -0,0 +1,77 @@
+import boto3
+import functools
+import logging
+from botocore.config import Config
+
+# Setup logging, Lambda already installs a handler on the root logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    formatter = logging.Formatter('%(asctime)s [%(process)s] [%(levelname)s] [%(funcName)s] %(message)s')
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+# Upper bound on regions processed concurrently
+MAX_REGION_WORKERS = 16
+
+# One session per Lambda container, creating sessions resolves credentials again
+SESSION = boto3.Session()
+# Adaptive retries rate limit the client and back off on Throttling / RequestLimitExceeded
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+
+# Clients are cached and reused across invocations. SESSION is not thread-safe, so callers
+# must build the clients they need before starting worker threads.
+@functools.lru_cache(maxsize=None)
+def get_ec2_client(region=None):
+    return SESSION.client('ec2', region_name=region, config=CLIENT_CONFIG)
+
+@functools.lru_cache(maxsize=None)
+def get_elbv2_client(region=None):
+    return SESSION.client('elbv2', region_name=region, config=CLIENT_CONFIG)
+
+@functools.lru_cache(maxsize=None)
+def get_regions():
+    # The region list does not change between invocations, describe it once per Lambda container
+    ec2 = get_ec2_client()
+    regions_response = ec2.describe_regions()
+    return [region['RegionName'] for region in regions_response['Regions']]
+
+def get_route_tables_by_subnet(ec2, vpc_id):
+    """
+    Map the subnets of a VPC to their route tables with a single API call.
+    
+    Parameters:
+        ec2: Boto3 EC2 client.
+        vpc_id: ID of the VPC.
+        
+    Returns:
+        A tuple of the route tables keyed by explicitly associated subnet ID,
+        and the main route table used by all other subnets (or None).
+        Each route table is flagged with 'HasInternetGatewayRoute'.
+    """
+    response = ec2.describe_route_tables(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+    route_tables = response.get('RouteTables', [])
+
+    # Scan the routes once per route table rather than once per subnet using it
+    for route_table in route_tables:
+        route_table['HasInternetGatewayRoute'] = any(
+            (route.get('GatewayId') or '').startswith('igw-') for route in route_table['Routes']
+        )
+
+    subnet_to_route_table = {
+        association['SubnetId']: route_table
+        for route_table in route_tables
+        for association in route_table.get('Associations', [])
+        if association.get('SubnetId')
+    }
+    main_route_table = next(
+        (route_table for route_table in route_tables
+         if any(association.get('Main') for association in route_table.get('Associations', []))),
+        None
+    )
+    return subnet_to_route_table, main_route_table
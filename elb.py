@@ -1,29 +1,20 @@
-import boto3
-import json
-import logging
-from botocore.config import Config
-from ipaddress import IPv6Network
+import concurrent.futures
+from common import MAX_REGION_WORKERS, get_elbv2_client, get_regions, logger
 
-# Setup logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s [%(process)s] [%(levelname)s] [%(funcName)s] %(message)s')
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# Upper bound on concurrent ELB API calls per region to stay under API throttling
+MAX_ELB_WORKERS = 20
 
-def enable_ipv6_for_alb(elbv2, alb_arn):
-    # Describe the load balancer to get current settings
-    response = elbv2.describe_load_balancers(LoadBalancerArns=[alb_arn])
-    load_balancer = response['LoadBalancers'][0]
+def enable_ipv6_for_alb(elbv2, load_balancer):
+    # The load balancer comes straight from the region-wide describe, no need to describe it again
+    alb_arn = load_balancer['LoadBalancerArn']
     # vpcids = ['vpc-077e3872c3c662828'] # comment ths line
 
     # if load_balancer['VpcId'] in vpcids :#comment this line
-    print(f"Processing ALB: {alb_arn}")
+    logger.info(f"Processing ALB: {alb_arn}")
 
     # Check if IPv6 is already enabled
     if 'dualstack' in load_balancer['IpAddressType'].lower():
-        print(f"IPv6 is already enabled for ALB: {alb_arn}")
+        logger.info(f"IPv6 is already enabled for ALB: {alb_arn}")
         return
 
     # Enable IPv6
@@ -31,49 +22,21 @@ def enable_ipv6_for_alb(elbv2, alb_arn):
         LoadBalancerArn=alb_arn,
         IpAddressType='dualstack'
     )
-    print(f"Enabled IPv6 for ALB: {alb_arn}")
-        
-    # Update ALB listeners to support IPv6
-    update_alb_listeners_to_support_ipv6(elbv2, alb_arn)
+    # Listeners follow the IP address type of the load balancer, they need no update
+    logger.info(f"Enabled IPv6 for ALB: {alb_arn}")
 
-def update_alb_listeners_to_support_ipv6(elbv2, alb_arn):
-    # Get all listeners for the load balancer
-    response = elbv2.describe_listeners(LoadBalancerArn=alb_arn)
-    listeners = response['Listeners']
+def enable_ipv6_for_all_albs_in_region(elbv2):
+    # Describe all ALBs in the region, page by page so large accounts are not truncated
+    paginator = elbv2.get_paginator('describe_load_balancers')
+    albs = [alb for page in paginator.paginate() for alb in page['LoadBalancers']]
 
-    for listener in listeners:
-        listener_arn = listener['ListenerArn']
-        port = listener['Port']
-        protocol = listener['Protocol']
-        default_actions = listener['DefaultActions']
+    # Enable IPv6 for the ALBs concurrently, the client is shared across threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_ELB_WORKERS) as executor:
+        list(executor.map(lambda alb: enable_ipv6_for_alb(elbv2, alb), albs))
 
-        print(f"Updating listener {listener_arn} to support IPv6")
-
-        # Modify listener to ensure IPv6 support
-        elbv2.modify_listener(
-            ListenerArn=listener_arn,
-            Port=port,
-            Protocol=protocol,
-            DefaultActions=default_actions
-        )
-        print(f"Updated listener {listener_arn} to support IPv6")
-
-def enable_ipv6_for_all_albs_in_region(region):
-    session = boto3.Session()
-    elbv2 = session.client('elbv2', region_name=region)
-
-    # Describe all ALBs in the region
-    response = elbv2.describe_load_balancers()
-    albs = response['LoadBalancers']
-
-    for alb in albs:
-        alb_arn = alb['LoadBalancerArn']
-        
-
-        # Enable IPv6 for the ALB
-        enable_ipv6_for_alb(elbv2, alb_arn)
-
-        
+def process_region(region, elbv2):
+    logger.info(f"Processing region: {region}")
+    enable_ipv6_for_all_albs_in_region(elbv2)
 
 def lambda_handler(event, context):
     """
@@ -83,15 +46,14 @@ def lambda_handler(event, context):
         event: Event data.
         context: Runtime information.
     """
-    session = boto3.Session()
-    ec2 = session.client('ec2')
-
     # Get all available regions
-    #ec2_regions = session.get_available_regions('ec2') uncomment this line
+    #ec2_regions = get_regions() uncomment this line
     ec2_regions = ["us-east-1"] #comment this line
-    for region in ec2_regions:
-        print(f"Processing region: {region}")
-        enable_ipv6_for_all_albs_in_region(region)
+    elbv2_clients = [get_elbv2_client(region) for region in ec2_regions]
+
+    # Process the regions concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_REGION_WORKERS) as executor:
+        list(executor.map(process_region, ec2_regions, elbv2_clients))
 
-    print("Completed updating ALBs to support IPv6 in all regions.")
+    logger.info("Completed updating ALBs to support IPv6 in all regions.")
 
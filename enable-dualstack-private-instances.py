@@ -1,36 +1,109 @@
-import boto3
-import json
-import logging
-from botocore.config import Config
-from ipaddress import IPv6Network
-
-# Setup logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s [%(process)s] [%(levelname)s] [%(funcName)s] %(message)s')
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-def assign_ipv6_addresses_to_instances(ec2_client, subnet_id):
-    # Describe instances in the subnet
-    response = ec2_client.describe_instances(
+import concurrent.futures
+from collections import defaultdict
+from common import MAX_REGION_WORKERS, get_ec2_client, get_regions, get_route_tables_by_subnet, logger
+
+# Upper bound on concurrent assign_ipv6_addresses calls to stay under the EC2 mutation throttle
+MAX_ASSIGN_WORKERS = 10
+
+# VPCs to process
+ALLOWED_VPCS = {"vpc-08bd2cb875fa89b38"}
+
+# Only running instances get an IPv6 address
+RUNNING_INSTANCE_FILTER = {'Name': 'instance-state-name', 'Values': ['running']}
+
+# Projects describe_instances pages to [InstanceId, [[SubnetId, NetworkInterfaceId], ...]] per instance
+INSTANCE_NETWORK_INTERFACES_EXPRESSION = (
+    'Reservations[].Instances[].[InstanceId, NetworkInterfaces[].[SubnetId, NetworkInterfaceId]]'
+)
+
+def get_network_interfaces_by_subnet(ec2_client, vpc_ids):
+    # Describe the running instances of all the VPCs once and group their network interfaces by subnet
+    eni_by_subnet = defaultdict(list)
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(
         Filters=[
-            {'Name': 'subnet-id', 'Values': [subnet_id]},
-            {'Name': 'instance-state-name', 'Values': ['running']}
+            {'Name': 'vpc-id', 'Values': vpc_ids},
+            RUNNING_INSTANCE_FILTER
         ]
     )
+    for instance_id, network_interfaces in page_iterator.search(INSTANCE_NETWORK_INTERFACES_EXPRESSION):
+        for subnet_id, network_interface_id in network_interfaces:
+            eni_by_subnet[subnet_id].append((instance_id, network_interface_id))
+    return eni_by_subnet
+
+def assign_ipv6_address_to_network_interface(ec2_client, instance_id, network_interface_id):
+    # Assign an IPv6 address to the network interface
+    ec2_client.assign_ipv6_addresses(
+        NetworkInterfaceId=network_interface_id,
+        Ipv6AddressCount=1
+    )
+    logger.info(f"Assigned IPv6 address to instance {instance_id}")
+
+def assign_ipv6_addresses_to_instances(ec2_client, subnet_id, eni_by_subnet):
+    network_interfaces = eni_by_subnet.get(subnet_id, [])
+    if not network_interfaces:
+        return
+
+    # The assignments are independent of each other, run them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_ASSIGN_WORKERS) as executor:
+        list(executor.map(
+            lambda eni: assign_ipv6_address_to_network_interface(ec2_client, *eni),
+            network_interfaces
+        ))
+
+def process_region(region, ec2_client):
+    """
+    Assign IPv6 addresses to the instances in private subnets of a region.
+    
+    Parameters:
+        region: Name of the region.
+        ec2_client: Boto3 EC2 client of the region.
+    """
+    logger.info(f"Processing region: {region}")
 
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            for network_interface in instance['NetworkInterfaces']:
-                if network_interface['SubnetId'] == subnet_id:
-                    # Assign an IPv6 address to the network interface
-                    ec2_client.assign_ipv6_addresses(
-                        NetworkInterfaceId=network_interface['NetworkInterfaceId'],
-                        Ipv6AddressCount=1
-                    )
-                    print(f"Assigned IPv6 address to instance {instance['InstanceId']}")
+    # List all VPCs in the region
+    vpcs_response = ec2_client.describe_vpcs()
+    vpc_ids = []
+    for vpc in vpcs_response['Vpcs']:
+        vpc_id = vpc['VpcId']
+        if vpc_id in ALLOWED_VPCS:
+            # Check if the VPC has IPv6 enabled
+            if 'Ipv6CidrBlockAssociationSet' not in vpc or not vpc['Ipv6CidrBlockAssociationSet']:
+                logger.info(f"vpc is not assigned IPv6 {vpc['VpcId']}")
+                continue  # Skip VPCs without IPv6 enabled
+            vpc_ids.append(vpc_id)
+
+    if not vpc_ids:
+        return
+
+    # Describe the running instances of all the VPCs at once
+    eni_by_subnet = get_network_interfaces_by_subnet(ec2_client, vpc_ids)
+
+    # List the subnets of all the VPCs at once
+    subnets_by_vpc = defaultdict(list)
+    paginator = ec2_client.get_paginator('describe_subnets')
+    for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': vpc_ids}]):
+        for subnet in page['Subnets']:
+            subnets_by_vpc[subnet['VpcId']].append(subnet)
+
+    for vpc_id in vpc_ids:
+        subnet_to_route_table, main_route_table = get_route_tables_by_subnet(ec2_client, vpc_id)
+
+        for subnet in subnets_by_vpc[vpc_id]:
+            subnet_id = subnet['SubnetId']
+            # Check if the subnet is private and has IPv6 enabled
+            route_table = subnet_to_route_table.get(subnet_id, main_route_table)
+            if route_table:
+                # Check if the subnet is private by looking for the absence of an internet gateway route
+                if route_table['HasInternetGatewayRoute']:
+                    continue
+
+                if 'Ipv6CidrBlockAssociationSet' not in subnet or not subnet['Ipv6CidrBlockAssociationSet']:
+                    logger.info(f"Subnet is not enabled for ipv6 {subnet_id}")
+                    continue  # Skip subnets without IPv6 enabled
+
+                # Assign IPv6 addresses to instances in the subnet
+                assign_ipv6_addresses_to_instances(ec2_client, subnet_id, eni_by_subnet)
 
 def lambda_handler(event, context):
     """
@@ -40,52 +113,11 @@ def lambda_handler(event, context):
         event: Event data.
         context: Runtime information.
     """
-    session = boto3.Session()
-    ec2 = session.client('ec2')
-    
     # List all AWS regions
-    regions_response = ec2.describe_regions()
-    #regions = [region['RegionName'] for region in regions_response['Regions']] uncomment this line
+    #regions = get_regions() uncomment this line
     regions = ["us-east-1"] # comment this line
+    ec2_clients = [get_ec2_client(region) for region in regions]
 
-    for region in regions:
-        print(f"Processing region: {region}")
-        ec2_client = session.client('ec2', region_name=region)
-
-        # List all VPCs in the region
-        vpcs_response = ec2_client.describe_vpcs()
-        for vpc in vpcs_response['Vpcs']:
-            vpc_id = vpc['VpcId']
-            if vpc_id in "vpc-08bd2cb875fa89b38":
-                # Check if the VPC has IPv6 enabled
-                if 'Ipv6CidrBlockAssociationSet' not in vpc or not vpc['Ipv6CidrBlockAssociationSet']:
-                    print(f"vpc is not assigned IPv6 {vpc['VpcId']}")
-                    continue  # Skip VPCs without IPv6 enabled
-    
-                # List all subnets in the VPC
-                subnets_response = ec2_client.describe_subnets(
-                    Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
-                )
-    
-                for subnet in subnets_response['Subnets']:
-                    subnet_id = subnet['SubnetId']
-                    # Check if the subnet is private and has IPv6 enabled
-                    route_table_response = ec2_client.describe_route_tables(
-                    Filters=[{'Name': 'association.subnet-id', 'Values': [subnet_id]}]
-                    )
-                    if route_table_response['RouteTables']:
-                        route_table = route_table_response['RouteTables'][0]
-    
-                        # Check if the subnet is private by looking for the absence of an internet gateway route
-                        igw_route = any(route.get('GatewayId', '').startswith('igw-') for route in route_table['Routes'])
-                        if igw_route :
-                            continue
-                        
-                       
-    
-                        if 'Ipv6CidrBlockAssociationSet' not in subnet or not subnet['Ipv6CidrBlockAssociationSet']:
-                            print(f"Subnet is not enabled for ipv6 {subnet_id}")
-                            continue  # Skip subnets without IPv6 enabled
-    
-                        # Assign IPv6 addresses to instances in the subnet
-                        assign_ipv6_addresses_to_instances(ec2_client, subnet_id)
+    # Process the regions concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_REGION_WORKERS) as executor:
+        list(executor.map(process_region, regions, ec2_clients))
@@ -1,48 +1,99 @@
-import boto3
-import json
-import logging
-from botocore.config import Config
+import concurrent.futures
+import functools
+import time
+from common import MAX_REGION_WORKERS, get_ec2_client, get_route_tables_by_subnet, logger
 from ipaddress import IPv6Network
 
-# Setup logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s [%(process)s] [%(levelname)s] [%(funcName)s] %(message)s')
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# Polling of the IPv6 CIDR block association of a VPC, the association is asynchronous
+IPV6_CIDR_POLL_DELAY = 2
+IPV6_CIDR_POLL_MAX_ATTEMPTS = 10
 
-def enable_ipv6_cidr_for_vpc(ec2, vpc_id):
+def wait_for_vpc_ipv6_cidr_block(ec2, vpc_id, association_id):
     """
-    Enable IPv6 CIDR for the specified VPC if not already enabled.
+    Wait until an IPv6 CIDR block association of a VPC is associated.
     
     Parameters:
         ec2: Boto3 EC2 client.
         vpc_id: ID of the VPC.
+        association_id: ID of the IPv6 CIDR block association.
+        
+    Returns:
+        The associated IPv6 CIDR block.
+    """
+    for _ in range(IPV6_CIDR_POLL_MAX_ATTEMPTS):
+        vpc = ec2.describe_vpcs(VpcIds=[vpc_id])['Vpcs'][0]
+        for association in vpc.get('Ipv6CidrBlockAssociationSet', []):
+            if association['AssociationId'] != association_id:
+                continue
+            state = association['Ipv6CidrBlockState']['State']
+            if state == 'associated':
+                return association['Ipv6CidrBlock']
+            if state == 'failed':
+                raise RuntimeError(f"IPv6 CIDR block association {association_id} failed for VPC {vpc_id}")
+        time.sleep(IPV6_CIDR_POLL_DELAY)
+
+    raise RuntimeError(f"IPv6 CIDR block association {association_id} of VPC {vpc_id} is still not associated")
+
+def enable_ipv6_cidr_for_vpc(ec2, vpc):
+    """
+    Enable IPv6 CIDR for the specified VPC if not already enabled.
+    
+    Parameters:
+        ec2: Boto3 EC2 client.
+        vpc: VPC as returned by describe_vpcs.
         
     Returns:
         The IPv6 CIDR block assigned to the VPC.
     """
-    response = ec2.describe_vpcs(VpcIds=[vpc_id])
-    vpc = response['Vpcs'][0]
+    vpc_id = vpc['VpcId']
     ipv6_cidr_block_associations = vpc.get('Ipv6CidrBlockAssociationSet', [])
     
     if not ipv6_cidr_block_associations:
         # Assign an Amazon provided IPv6 CIDR block to the VPC
         response = ec2.associate_vpc_cidr_block(VpcId=vpc_id, AmazonProvidedIpv6CidrBlock=True)
-        # Describe VPC again to get the newly assigned IPv6 CIDR block
-        resp = ec2.describe_vpcs(VpcIds=[vpc_id])
-        vpcs = resp.get('Vpcs', [])
-        vpc = vpcs[0]
-        ipv6_cidr_block_associations = vpc.get('Ipv6CidrBlockAssociationSet', [])
-        ipv6_cidr_block = ipv6_cidr_block_associations[0]['Ipv6CidrBlock']
-        print(f"Assigned IPv6 CIDR block {ipv6_cidr_block} to VPC {vpc_id}")
+        association_id = response['Ipv6CidrBlockAssociation']['AssociationId']
+
+        # The response of an Amazon provided block carries no CIDR yet, it is known once associated
+        ipv6_cidr_block = wait_for_vpc_ipv6_cidr_block(ec2, vpc_id, association_id)
+        logger.info(f"Assigned IPv6 CIDR block {ipv6_cidr_block} to VPC {vpc_id}")
     else:
         ipv6_cidr_block = ipv6_cidr_block_associations[0]['Ipv6CidrBlock']
-        print(f"VPC {vpc_id} already has IPv6 CIDR block {ipv6_cidr_block}")
+        logger.info(f"VPC {vpc_id} already has IPv6 CIDR block {ipv6_cidr_block}")
 
     return ipv6_cidr_block
 
+@functools.lru_cache(maxsize=None)
+def describe_vpc_subnets(ec2, vpc_id):
+    """
+    Describe the subnets of a VPC, cached for the current invocation.
+    
+    Parameters:
+        ec2: Boto3 EC2 client.
+        vpc_id: ID of the VPC.
+        
+    Returns:
+        The subnets of the VPC.
+    """
+    response = ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+    return response.get('Subnets', [])
+
+def get_subnet_ipv6_network(vpc_ipv6_network, subnet_size, index):
+    """
+    Calculate the IPv6 network of the n-th subnet carved out of a VPC IPv6 network.
+    
+    Parameters:
+        vpc_ipv6_network: IPv6 network of the VPC.
+        subnet_size: Prefix length of the subnet networks.
+        index: Position of the subnet network within the VPC network.
+        
+    Returns:
+        The IPv6 network of the subnet.
+    """
+    if index >= 2 ** (subnet_size - vpc_ipv6_network.prefixlen):
+        raise ValueError(f"No /{subnet_size} block left in {vpc_ipv6_network} for subnet number {index}")
+    network_address = int(vpc_ipv6_network.network_address) | (index << (128 - subnet_size))
+    return IPv6Network((network_address, subnet_size))
+
 def assign_ipv6_cidr_to_subnets(ec2, vpc_id, ipv6_cidr_block):
     """
     Assign IPv6 CIDR blocks to all subnets within a VPC.
@@ -52,8 +103,7 @@ def assign_ipv6_cidr_to_subnets(ec2, vpc_id, ipv6_cidr_block):
         vpc_id: ID of the VPC.
         ipv6_cidr_block: IPv6 CIDR block assigned to the VPC.
     """
-    response = ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-    subnets = response.get('Subnets', [])
+    subnets = describe_vpc_subnets(ec2, vpc_id)
     
     # Calculate the subnet IPv6 CIDR blocks
     vpc_ipv6_network = IPv6Network(ipv6_cidr_block)
@@ -65,69 +115,111 @@ def assign_ipv6_cidr_to_subnets(ec2, vpc_id, ipv6_cidr_block):
 
         if not ipv6_cidr_block_associations:
             # Calculate the IPv6 CIDR block for this subnet
-            subnet_ipv6_network = list(vpc_ipv6_network.subnets(new_prefix=subnet_size))[index]
+            subnet_ipv6_network = get_subnet_ipv6_network(vpc_ipv6_network, subnet_size, index)
             subnet_ipv6_cidr_block = str(subnet_ipv6_network)
 
             # Assign the IPv6 CIDR block to the subnet
             response = ec2.associate_subnet_cidr_block(SubnetId=subnet_id, Ipv6CidrBlock=subnet_ipv6_cidr_block)
-            print(f"Assigned IPv6 CIDR block {subnet_ipv6_cidr_block} to Subnet {subnet_id}")
+            logger.info(f"Assigned IPv6 CIDR block {subnet_ipv6_cidr_block} to Subnet {subnet_id}")
         else:
-            print(f"Subnet {subnet_id} already has IPv6 CIDR blocks assigned.")
+            logger.info(f"Subnet {subnet_id} already has IPv6 CIDR blocks assigned.")
 
-def create_and_attach_egress_only_igw(ec2, vpc_id):
+def get_egress_only_igws_by_vpc(ec2):
+    """
+    Map the VPCs of a region to their attached Egress-Only Internet Gateway.
+    
+    Parameters:
+        ec2: Boto3 EC2 client.
+        
+    Returns:
+        The Egress-Only Internet Gateway IDs keyed by VPC ID.
+    """
+    paginator = ec2.get_paginator('describe_egress_only_internet_gateways')
+    return {
+        attachment['VpcId']: igw['EgressOnlyInternetGatewayId']
+        for page in paginator.paginate()
+        for igw in page.get('EgressOnlyInternetGateways', [])
+        for attachment in igw.get('Attachments', [])
+    }
+
+def create_and_attach_egress_only_igw(ec2, vpc_id, egress_only_igws_by_vpc):
     """
     Create an Egress-Only Internet Gateway if not already exists and attach it to private subnets.
     
     Parameters:
         ec2: Boto3 EC2 client.
         vpc_id: ID of the VPC.
+        egress_only_igws_by_vpc: Existing Egress-Only Internet Gateway IDs keyed by VPC ID.
     """
     # Check if an egress-only internet gateway already exists
-    response = ec2.describe_egress_only_internet_gateways()
-    egress_only_igws = response.get('EgressOnlyInternetGateways', [])
-    
-    egress_only_igw_id = None
-    for igw in egress_only_igws:
-        attachments = igw.get('Attachments', [])
-        if any(attachment['VpcId'] == vpc_id for attachment in attachments):
-            egress_only_igw_id = igw['EgressOnlyInternetGatewayId']
-            break
+    egress_only_igw_id = egress_only_igws_by_vpc.get(vpc_id)
 
     if not egress_only_igw_id:
         # Create an egress-only internet gateway
         response = ec2.create_egress_only_internet_gateway(VpcId=vpc_id)
         egress_only_igw_id = response['EgressOnlyInternetGateway']['EgressOnlyInternetGatewayId']
-        print(f"Created Egress-Only Internet Gateway: {egress_only_igw_id}")
+        logger.info(f"Created Egress-Only Internet Gateway: {egress_only_igw_id}")
     else:
-        print(f"Egress-Only Internet Gateway {egress_only_igw_id} already exists for VPC {vpc_id}")
+        logger.info(f"Egress-Only Internet Gateway {egress_only_igw_id} already exists for VPC {vpc_id}")
 
     # Describe subnets in the VPC
-    response = ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-    subnets = response.get('Subnets', [])
+    subnets = describe_vpc_subnets(ec2, vpc_id)
     
+    subnet_to_route_table, main_route_table = get_route_tables_by_subnet(ec2, vpc_id)
+
     private_subnets = []
     route_tables = []
 
     for subnet in subnets:
         subnet_id = subnet['SubnetId']
-        route_table_response = ec2.describe_route_tables(Filters=[{'Name': 'association.subnet-id', 'Values': [subnet_id]}])
-        if route_table_response['RouteTables']:
-            route_table = route_table_response['RouteTables'][0]
+        route_table = subnet_to_route_table.get(subnet_id, main_route_table)
+        if route_table:
             # Check if the subnet is private by looking for the absence of an internet gateway route
-            igw_route = any(route.get('GatewayId', '').startswith('igw-') for route in route_table['Routes'])
-            if not igw_route:
+            if not route_table['HasInternetGatewayRoute']:
                 private_subnets.append(subnet_id)
-                route_tables.append(route_table['RouteTableId'])
+                if route_table['RouteTableId'] not in route_tables:
+                    route_tables.append(route_table['RouteTableId'])
 
-    print(f"Identified private subnets in VPC {vpc_id}: {private_subnets}")
+    logger.info(f"Identified private subnets in VPC {vpc_id}: {private_subnets}")
 
     # Attach the egress-only internet gateway to the private subnets' route tables
     for route_table_id in route_tables:
         try:
             ec2.create_route(RouteTableId=route_table_id, DestinationIpv6CidrBlock='::/0', EgressOnlyInternetGatewayId=egress_only_igw_id)
-            print(f"Added route to route table {route_table_id} via egress-only internet gateway {egress_only_igw_id}")
+            logger.info(f"Added route to route table {route_table_id} via egress-only internet gateway {egress_only_igw_id}")
         except Exception as e:
-            print(f"Error adding route to route table {route_table_id}: {e}")
+            logger.error(f"Error adding route to route table {route_table_id}: {e}")
+
+def process_region(region, ec2):
+    """
+    Enable IPv6 on all VPCs and subnets of a region.
+    
+    Parameters:
+        region: Name of the region.
+        ec2: Boto3 EC2 client of the region.
+    """
+    logger.info(f"Processing region: {region}")
+
+    # Describe the egress-only internet gateways once for all VPCs of the region
+    egress_only_igws_by_vpc = get_egress_only_igws_by_vpc(ec2)
+
+    response = ec2.describe_vpcs()
+    
+    vpcs = response.get('Vpcs', []) #uncomment it
+    # vpcs = ["vpc-05999aa1be45ff7ac"] # comment it
+    for vpc in vpcs:
+        vpc_id = vpc['VpcId'] #uncommnt it
+        #vpc_id = vpcs[0] #comment it
+        logger.info(f"Processing VPC {vpc_id} in region {region}")
+
+        # Step 1: Enable IPv6 CIDR for the VPC if not already enabled
+        ipv6_cidr_block = enable_ipv6_cidr_for_vpc(ec2, vpc)
+
+        # Step 2: Assign IPv6 CIDR range to all subnets from the CIDR range of the VPC
+        assign_ipv6_cidr_to_subnets(ec2, vpc_id, ipv6_cidr_block)
+
+        # Step 3: Create egress-only internet gateway if not present and attach it to private subnets
+        create_and_attach_egress_only_igw(ec2, vpc_id, egress_only_igws_by_vpc)
 
 def lambda_handler(event, context):
     """
@@ -138,29 +230,14 @@ def lambda_handler(event, context):
         event: Event data.
         context: Runtime information.
     """
-    session = boto3.Session()
     ec2_regions = ["us-east-1"]  # Specify the regions to process
-    for region in ec2_regions:
-        print(f"Processing region: {region}")
-        ec2 = boto3.client('ec2', region_name=region)
-        elbv2 = boto3.client('elbv2', region_name=region)
-    
-        response = ec2.describe_vpcs()
-        
-        vpcs = response.get('Vpcs', []) #uncomment it
-        # vpcs = ["vpc-05999aa1be45ff7ac"] # comment it
-        for vpc in vpcs:
-            vpc_id = vpc['VpcId'] #uncommnt it
-            #vpc_id = vpcs[0] #comment it
-            print(f"Processing VPC {vpc_id} in region {region}")
-    
-            # Step 1: Enable IPv6 CIDR for the VPC if not already enabled
-            ipv6_cidr_block = enable_ipv6_cidr_for_vpc(ec2, vpc_id)
-    
-            # Step 2: Assign IPv6 CIDR range to all subnets from the CIDR range of the VPC
-            assign_ipv6_cidr_to_subnets(ec2, vpc_id, ipv6_cidr_block)
-    
-            # Step 3: Create egress-only internet gateway if not present and attach it to private subnets
-            create_and_attach_egress_only_igw(ec2, vpc_id)
+    ec2_clients = [get_ec2_client(region) for region in ec2_regions]
+
+    # Do not serve descriptions cached by a previous invocation of a warm container
+    describe_vpc_subnets.cache_clear()
+
+    # Process the regions concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_REGION_WORKERS) as executor:
+        list(executor.map(process_region, ec2_regions, ec2_clients))
     
-    print("Completed processing all regions.")
+    logger.info("Completed processing all regions.")